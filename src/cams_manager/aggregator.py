@@ -4,20 +4,40 @@ import json
 import logging
 import os
 import subprocess
-import tempfile
 import threading
 import time
-from collections import defaultdict
+from collections import deque
+from concurrent.futures import CancelledError, ThreadPoolExecutor
 from datetime import datetime, timedelta
+from itertools import groupby, repeat
 from pathlib import Path
 
+from .probe import ProbeCache, ProbeResult, probe_mp4_fast
+from .watcher import DirectoryWatcher
+
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_MAX_CONCURRENT_MERGES = 2
+
+# Shared by all aggregators unless one is given a semaphore explicitly
+_merge_semaphore = threading.BoundedSemaphore(DEFAULT_MAX_CONCURRENT_MERGES)
+
+
+# Segment probes from every merge share one pool, so concurrent ffprobe
+# processes stay bounded however many minutes are being merged
+PROBE_WORKERS = min(8, os.cpu_count() or 4)
+_probe_pool = ThreadPoolExecutor(max_workers=PROBE_WORKERS, thread_name_prefix="probe")
+
 
 class SegmentAggregator:
     """Merges short segments into longer files"""
 
+    MERGE_WORKERS = 2  # Minute groups one aggregator merges concurrently
+    MIN_COMPLETE_BYTES = 64 * 1024  # Segments at least this big skip ffprobe
+    STDERR_TAIL_LINES = 512  # FFmpeg stderr lines kept for error logs
+    SENDFILE_CHUNK = 1024 * 1024  # Bytes per sendfile() call for TS merges
+
     def __init__(
         self,
         name: str,
@@ -25,258 +45,500 @@ class SegmentAggregator:
         merged_dir: Path,
         merge_interval: int,
         merge_delay: int,
+        ffmpeg_threads: int = 1,
+        merge_semaphore: threading.Semaphore | None = None,
+        segment_format: str = "mp4",
     ):
         self.name = name
         self.segments_dir = Path(segments_dir)
         self.merged_dir = Path(merged_dir)
+        # Resolved once so filelists can be built without a realpath per segment
+        self._segments_dir_resolved = self.segments_dir.resolve()
         self.merge_interval = merge_interval
         self.merge_delay = merge_delay
+        self.ffmpeg_threads = ffmpeg_threads
+        # Limits concurrent merge FFmpeg processes across cameras
+        self._merge_semaphore = merge_semaphore or _merge_semaphore
+        # Container of segments and merged files ("mp4" or "ts")
+        self.segment_format = segment_format
+        self._suffix = f".{segment_format}"
+
+        # Segments older than the merge cutoff, grouped by minute key
+        # (YYYYMMDD_HHMM) with the minute's start time, so each interval only
+        # has to stat new files
+        self._minute_index: dict[str, tuple[datetime, list[Path]]] = {}
+        self._indexed_names: set[str] = set()
+
+        # Minute key -> earliest time a scan can merge newly written segments
+        self._pending_scans: dict[str, float] = {}
+        self._watcher: DirectoryWatcher | None = None
 
         self._thread: threading.Thread | None = None
         self._stop_event = threading.Event()
 
+        # Each camera has its own merge pool so one camera's backlog doesn't
+        # queue ahead of the others; the merge semaphore still caps how many
+        # FFmpeg processes run. stop() kills the merge FFmpegs still running
+        self._merge_pool = self._new_merge_pool()
+        self._merge_processes: set[subprocess.Popen] = set()
+        self._merge_processes_lock = threading.Lock()
+
         # Create merged directory if it doesn't exist
         self.merged_dir.mkdir(parents=True, exist_ok=True)
 
+        self._remove_stale_partials()
+
+        # Probe results survive restarts so deferred segments aren't re-probed
+        self._probe_cache = ProbeCache(
+            self.merged_dir / ".probe_cache.json", self._probe_segment
+        )
+
     def _parse_filename_time(self, filename: str) -> datetime | None:
         """Parse datetime from filename format: YYYYMMDD_HHMMSS.mp4"""
+        # Fixed-width format, so slice the fields instead of using strptime
+        s = filename
+        if (
+            len(s) < 15
+            or s[8] != "_"
+            or s[15:16] not in ("", ".")
+            or not (s[:8].isdigit() and s[9:15].isdigit())
+        ):
+            return None
         try:
-            # Remove extension
-            name_without_ext = filename.rsplit(".", 1)[0]
-            return datetime.strptime(name_without_ext, "%Y%m%d_%H%M%S")
+            return datetime(
+                int(s[0:4]),
+                int(s[4:6]),
+                int(s[6:8]),
+                int(s[9:11]),
+                int(s[11:13]),
+                int(s[13:15]),
+            )
         except ValueError:
             return None
 
-    def _get_time_key(self, dt: datetime) -> str:
-        """Get time key for grouping (YYYYMMDD_HHMM)"""
-        return dt.strftime("%Y%m%d_%H%M")
-
-    def _group_segments_by_minute(self, segments: list[Path]) -> dict[str, list[Path]]:
-        """Group segments by minute"""
-        groups = defaultdict(list)
-
+    def _group_segments_by_minute(
+        self, segments: list[Path]
+    ) -> dict[str, tuple[datetime, list[Path]]]:
+        """Group segments by minute, keeping each minute's start time"""
+        parsed = []
         for segment in segments:
             filename_time = self._parse_filename_time(segment.name)
             if filename_time is None:
                 logger.warning(
-                    f"[{self.name}] Cannot parse time from filename: {segment.name}"
+                    "[%s] Cannot parse time from filename: %s", self.name, segment.name
                 )
                 continue
+            parsed.append((segment, filename_time))
+
+        # Names sort chronologically, so one sort leaves every minute
+        # contiguous and already ordered; the key (YYYYMMDD_HHMM) is the prefix
+        parsed.sort(key=lambda item: item[0].name)
+
+        groups: dict[str, tuple[datetime, list[Path]]] = {}
+        for time_key, items in groupby(parsed, key=lambda item: item[0].name[:13]):
+            group = list(items)
+            groups[time_key] = (
+                group[0][1].replace(second=0),
+                [segment for segment, _ in group],
+            )
 
-            time_key = self._get_time_key(filename_time)
-            groups[time_key].append(segment)
+        return groups
 
-        # Sort segments within each group
-        for time_key in groups:
-            groups[time_key].sort(key=lambda p: p.name)
+    def _probe_segment(self, segment: Path) -> ProbeResult | None:
+        """Validate segment, returning its metadata if usable"""
+        # Read the moov box directly; only fall back to ffprobe if it can't
+        # be parsed or reports no duration (e.g. fragmented MP4)
+        fast_result = None if self.segment_format == "ts" else probe_mp4_fast(segment)
+        if fast_result is not None:
+            has_video, duration = fast_result
+            if not has_video:
+                logger.warning(
+                    "[%s] Skipping segment without video stream: %s",
+                    self.name,
+                    segment.name,
+                )
+                return None
+            if duration > 0:
+                return {"has_video": True, "duration": duration}
+
+        return self._ffprobe_segment(segment)
+
+    def _ffprobe_segment(self, segment: Path) -> ProbeResult | None:
+        """Validate segment with ffprobe, returning its metadata if usable"""
+        probe_cmd = [
+            "ffprobe",
+            "-v",
+            "error",
+            # One thread per probe; probes already run in parallel
+            "-threads",
+            "1",
+            "-show_entries",
+            "format=duration:stream=codec_type,nb_read_packets",
+            "-of",
+            "json",
+            str(segment),
+        ]
+        probe_result = subprocess.run(
+            probe_cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            timeout=5,
+        )
 
-        return groups
+        if probe_result.returncode != 0:
+            logger.warning(
+                "[%s] Skipping corrupted/incomplete segment: %s (ffprobe failed: %s)",
+                self.name,
+                segment.name,
+                probe_result.stderr.decode("utf-8", errors="ignore")[:100],
+            )
+            return None
 
-    def _merge_segments(
-        self,
-        segments: list[Path],
-        output_path: Path,
-    ) -> bool:
-        """Merge segments using FFmpeg concat demuxer"""
-        if not segments:
-            return False
+        # Parse JSON output to validate file integrity
+        try:
+            probe_data = json.loads(probe_result.stdout.decode("utf-8"))
+        except json.JSONDecodeError as e:
+            logger.warning(
+                "[%s] Skipping segment with invalid ffprobe output: %s (JSON error: %s)",
+                self.name,
+                segment.name,
+                e,
+            )
+            return None
 
-        # Filter out incomplete/corrupted segments
-        valid_segments = []
-        for segment in segments:
-            if not segment.exists():
-                logger.warning(f"[{self.name}] Segment file does not exist: {segment}")
-                continue
+        # Check if there are any streams
+        streams = probe_data.get("streams", [])
+        if not streams:
+            logger.warning(
+                "[%s] Skipping segment without streams: %s", self.name, segment.name
+            )
+            return None
 
-            try:
-                file_size = segment.stat().st_size
-                # Check if file is too small (likely incomplete)
-                if file_size < 1024:  # Less than 1KB is likely incomplete
-                    logger.warning(
-                        f"[{self.name}] Skipping small/incomplete segment: {segment.name} "
-                        f"(size: {file_size} bytes)"
-                    )
-                    continue
+        # Check if there's at least one video stream
+        has_video = any(s.get("codec_type") == "video" for s in streams)
+        if not has_video:
+            logger.warning(
+                "[%s] Skipping segment without video stream: %s",
+                self.name,
+                segment.name,
+            )
+            return None
 
-                # Check if file has valid video stream and duration using ffprobe
-                probe_cmd = [
-                    "ffprobe",
-                    "-v",
-                    "error",
-                    "-show_entries",
-                    "format=duration:stream=codec_type,nb_read_packets",
-                    "-of",
-                    "json",
-                    str(segment),
-                ]
-                probe_result = subprocess.run(
-                    probe_cmd,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    timeout=5,
-                )
+        # Check if format has valid duration
+        format_info = probe_data.get("format", {})
+        duration = format_info.get("duration")
+        if duration is None or duration == "N/A":
+            logger.warning(
+                "[%s] Skipping segment with invalid duration: %s (duration: %s)",
+                self.name,
+                segment.name,
+                duration,
+            )
+            return None
 
-                if probe_result.returncode != 0:
-                    logger.warning(
-                        f"[{self.name}] Skipping corrupted/incomplete segment: {segment.name} "
-                        f"(ffprobe failed: {probe_result.stderr.decode('utf-8', errors='ignore')[:100]})"
-                    )
-                    continue
+        # Check if duration is a valid number and not zero
+        try:
+            duration_float = float(duration)
+        except (ValueError, TypeError):
+            logger.warning(
+                "[%s] Skipping segment with unparseable duration: %s (duration: %s)",
+                self.name,
+                segment.name,
+                duration,
+            )
+            return None
 
-                # Parse JSON output to validate file integrity
-                try:
-                    probe_data = json.loads(probe_result.stdout.decode("utf-8"))
+        if duration_float <= 0:
+            logger.warning(
+                "[%s] Skipping segment with zero/negative duration: %s (duration: %ss)",
+                self.name,
+                segment.name,
+                duration_float,
+            )
+            return None
 
-                    # Check if there are any streams
-                    streams = probe_data.get("streams", [])
-                    if not streams:
-                        logger.warning(
-                            f"[{self.name}] Skipping segment without streams: {segment.name}"
-                        )
-                        continue
+        return {"has_video": True, "duration": duration_float}
 
-                    # Check if there's at least one video stream
-                    has_video = any(s.get("codec_type") == "video" for s in streams)
+    def _is_likely_complete(self, stat_result: os.stat_result, now_ts: float) -> bool:
+        """Check if segment size and age indicate FFmpeg finished writing it"""
+        return (
+            stat_result.st_size > self.MIN_COMPLETE_BYTES
+            and now_ts - stat_result.st_mtime > self.merge_delay + 5
+        )
+
+    def _probe_one(self, segment: Path, now_ts: float) -> tuple[Path, bool, bool]:
+        """Check a single segment, returning (segment, is_valid, fast_path)"""
+        if not segment.exists():
+            logger.warning("[%s] Segment file does not exist: %s", self.name, segment)
+            return segment, False, False
+
+        try:
+            stat_result = segment.stat()
+            file_size = stat_result.st_size
+            # Check if file is too small (likely incomplete)
+            if file_size < 1024:  # Less than 1KB is likely incomplete
+                logger.warning(
+                    "[%s] Skipping small/incomplete segment: %s (size: %s bytes)",
+                    self.name,
+                    segment.name,
+                    file_size,
+                )
+                return segment, False, False
+
+            # Large, settled segments only need their moov box to be present;
+            # anything suspicious goes through the full (cached) probe
+            probe = None
+            if self._is_likely_complete(stat_result, now_ts):
+                if self.segment_format == "ts":
+                    # TS has no trailing index, a settled segment is complete
+                    return segment, True, True
+                fast_result = probe_mp4_fast(segment)
+                if fast_result is not None:
+                    has_video, duration = fast_result
                     if not has_video:
                         logger.warning(
-                            f"[{self.name}] Skipping segment without video stream: {segment.name}"
+                            "[%s] Skipping segment without video stream: %s",
+                            self.name,
+                            segment.name,
                         )
-                        continue
+                        return segment, False, True
+                    # A zero duration is left to the full probe to reject
+                    if duration > 0:
+                        return segment, True, True
+                # The moov box was already parsed, so go straight to ffprobe
+                probe = self._ffprobe_segment
+
+            # Check if file has valid video stream and duration (cached)
+            if self._probe_cache.get_or_probe(segment, stat_result, probe) is None:
+                return segment, False, False
+
+            return segment, True, False
+        except subprocess.TimeoutExpired:
+            logger.warning(
+                "[%s] Timeout checking segment: %s, skipping", self.name, segment.name
+            )
+            return segment, False, False
+        except Exception as e:
+            logger.warning(
+                "[%s] Error checking segment %s: %s, skipping",
+                self.name,
+                segment.name,
+                e,
+            )
+            return segment, False, False
 
-                    # Check if format has valid duration
-                    format_info = probe_data.get("format", {})
-                    duration = format_info.get("duration")
-                    if duration is None or duration == "N/A":
-                        logger.warning(
-                            f"[{self.name}] Skipping segment with invalid duration: {segment.name} "
-                            f"(duration: {duration})"
-                        )
-                        continue
+    def _validate_segments_bulk(self, segments: list[Path]) -> list[Path]:
+        """Return the subset of segments that are complete and playable"""
+        now_ts = time.time()
 
-                    # Check if duration is a valid number and not zero
-                    try:
-                        duration_float = float(duration)
-                        if duration_float <= 0:
-                            logger.warning(
-                                f"[{self.name}] Skipping segment with zero/negative duration: {segment.name} "
-                                f"(duration: {duration_float}s)"
-                            )
-                            continue
-                    except (ValueError, TypeError):
-                        logger.warning(
-                            f"[{self.name}] Skipping segment with unparseable duration: {segment.name} "
-                            f"(duration: {duration})"
-                        )
-                        continue
+        # Probes are independent subprocesses, so run them concurrently;
+        # map() keeps results in input order
+        results = list(
+            _probe_pool.map(self._probe_one, segments, repeat(now_ts, len(segments)))
+        )
+
+        fast_count = sum(1 for _, _, fast_path in results if fast_path)
+        logger.debug(
+            "[%s] Validated %s segments: %s fast-path, %s probe-path",
+            self.name,
+            len(segments),
+            fast_count,
+            len(segments) - fast_count,
+        )
+
+        return [segment for segment, is_valid, _ in results if is_valid]
 
-                except json.JSONDecodeError as e:
+    def _delete_segments(self, segments: list[Path]) -> int:
+        """Delete segments, returning how many were removed"""
+        deleted_count = 0
+        # Unlink relative to an open directory fd so the parent path is not
+        # walked again for every file
+        dir_fd = os.open(self.segments_dir, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            for segment in segments:
+                try:
+                    if segment.parent == self.segments_dir:
+                        os.unlink(segment.name, dir_fd=dir_fd)
+                    else:
+                        segment.unlink()
+                    deleted_count += 1
+                except FileNotFoundError:
+                    pass
+                except Exception as e:
                     logger.warning(
-                        f"[{self.name}] Skipping segment with invalid ffprobe output: {segment.name} "
-                        f"(JSON error: {e})"
+                        "[%s] Failed to delete segment %s: %s",
+                        self.name,
+                        segment.name,
+                        e,
                     )
-                    continue
+        finally:
+            os.close(dir_fd)
 
-                valid_segments.append(segment)
-            except subprocess.TimeoutExpired:
-                logger.warning(
-                    f"[{self.name}] Timeout checking segment: {segment.name}, skipping"
-                )
-                continue
-            except Exception as e:
-                logger.warning(
-                    f"[{self.name}] Error checking segment {segment.name}: {e}, skipping"
-                )
-                continue
+        return deleted_count
+
+    def _new_merge_pool(self) -> ThreadPoolExecutor:
+        """Create the thread pool minute groups are merged on"""
+        return ThreadPoolExecutor(
+            max_workers=self.MERGE_WORKERS, thread_name_prefix=f"merge-{self.name}"
+        )
+
+    def _run_merge_ffmpeg(
+        self, cmd: list[str], stdin_data: bytes, timeout: float
+    ) -> tuple[int, str]:
+        """Run merge FFmpeg, returning its return code and stderr tail"""
+        process = subprocess.Popen(
+            cmd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+        with self._merge_processes_lock:
+            self._merge_processes.add(process)
+            # stop() may have run before the process was registered
+            if self._stop_event.is_set():
+                process.kill()
+
+        # Drain stderr line by line, keeping only the last lines for logging
+        stderr_tail: deque[bytes] = deque(maxlen=self.STDERR_TAIL_LINES)
+        reader = threading.Thread(
+            target=stderr_tail.extend, args=(process.stderr,), daemon=True
+        )
+        reader.start()
+
+        try:
+            try:
+                process.stdin.write(stdin_data)
+            except BrokenPipeError:
+                # FFmpeg exited early; its stderr explains why
+                pass
+            finally:
+                process.stdin.close()
+
+            returncode = process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+            raise
+        finally:
+            reader.join()
+            process.stderr.close()
+            with self._merge_processes_lock:
+                self._merge_processes.discard(process)
+
+        return returncode, b"".join(stderr_tail).decode("utf-8", errors="replace")
+
+    def _merge_segments(
+        self,
+        segments: list[Path],
+        output_path: Path,
+    ) -> bool:
+        """Merge segments using FFmpeg concat demuxer"""
+        if not segments or self._stop_event.is_set():
+            return False
+
+        # Filter out incomplete/corrupted segments
+        valid_segments = self._validate_segments_bulk(segments)
 
         if not valid_segments:
             logger.warning(
-                f"[{self.name}] No valid segments to merge (all {len(segments)} segments "
-                f"were incomplete or corrupted)"
+                "[%s] No valid segments to merge (all %s segments were incomplete or corrupted)",
+                self.name,
+                len(segments),
             )
             return False
 
         if len(valid_segments) < len(segments):
             logger.warning(
-                f"[{self.name}] Filtered out {len(segments) - len(valid_segments)} "
-                f"incomplete/corrupted segments, merging {len(valid_segments)} valid ones"
+                "[%s] Filtered out %s incomplete/corrupted segments, merging %s valid ones",
+                self.name,
+                len(segments) - len(valid_segments),
+                len(valid_segments),
             )
 
-        # Create temporary file list with only valid segments
-        with tempfile.NamedTemporaryFile(
-            mode="w", suffix=".txt", delete=False, encoding="utf-8"
-        ) as f:
-            filelist_path = Path(f.name)
-            for segment in valid_segments:
-                # Use absolute path and escape single quotes
-                abs_path = segment.resolve()
-                f.write(f"file '{abs_path}'\n")
-            f.flush()  # Ensure data is written to buffer
-            os.fsync(f.fileno())  # Force write to disk
-
-        if logger.level == logging.DEBUG:
-            try:
-                with open(filelist_path, "r", encoding="utf-8") as check_f:
-                    filelist_content = check_f.read()
-                    logger.debug(
-                        f"[{self.name}] File list content ({len(filelist_content)} bytes):\n{filelist_content[:200]}"
-                    )
-            except Exception as e:
-                logger.warning(f"[{self.name}] Could not verify file list: {e}")
-
-        # Small delay to ensure file system sync
-        time.sleep(0.2)
+        if self.segment_format == "ts":
+            return self._merge_ts_fast(valid_segments, output_path)
+
+        # Build the concat list in memory; it is fed to FFmpeg over stdin
+        lines = []
+        for segment in valid_segments:
+            # Use absolute path and escape single quotes
+            if segment.parent == self.segments_dir:
+                abs_path = str(self._segments_dir_resolved / segment.name)
+            else:
+                abs_path = str(segment.resolve())
+            abs_path = abs_path.replace("'", "'\\''")
+            lines.append(f"file '{abs_path}'\n")
+        filelist_content = "".join(lines)
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "[%s] File list content (%s bytes):\n%s",
+                self.name,
+                len(filelist_content),
+                filelist_content[:200],
+            )
 
         try:
-            # Use temporary output file first (atomic write)
-            # Use .mp4.tmp instead of .tmp so FFmpeg can infer the format
-            temp_output = output_path.with_suffix(".mp4.tmp")
+            # Use temporary output file first (atomic write); it keeps the
+            # .mp4 extension so FFmpeg infers the format from the name
+            temp_output = self._partial_path(output_path)
 
             # Build FFmpeg command with protocol whitelist
             cmd = [
                 "ffmpeg",
+                "-nostdin",  # Don't read from stdin
+                "-loglevel",
+                "error",  # Only keep errors in the captured stderr
                 "-protocol_whitelist",
-                "file,concat",
+                "file,pipe,concat",
+                # Stream copy gains nothing from extra threads
+                "-threads",
+                str(self.ffmpeg_threads),
                 "-f",
                 "concat",
                 "-safe",
                 "0",
                 "-i",
-                str(filelist_path),
+                "pipe:0",  # Read the concat list from stdin
                 "-c",
                 "copy",  # Copy codec, no re-encoding
-                "-f",
-                "mp4",  # Explicitly specify output format
                 "-y",  # Overwrite output file
                 str(temp_output),
             ]
 
             logger.debug(
-                f"[{self.name}] Merging {len(valid_segments)} segments into {output_path.name}"
-            )
-            logger.debug(f"[{self.name}] FFmpeg command: {' '.join(cmd)}")
-
-            # Run FFmpeg
-            result = subprocess.run(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                timeout=300,  # 5 minutes timeout
+                "[%s] Merging %s segments into %s",
+                self.name,
+                len(valid_segments),
+                output_path.name,
             )
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("[%s] FFmpeg command: %s", self.name, " ".join(cmd))
+
+            # Run FFmpeg; validation above stays outside the semaphore so
+            # probing for different cameras can still overlap
+            with self._merge_semaphore:
+                # The semaphore may have been waited on for a while
+                if self._stop_event.is_set():
+                    return False
+                returncode, stderr_tail = self._run_merge_ffmpeg(
+                    cmd,
+                    filelist_content.encode("utf-8"),
+                    timeout=300,  # 5 minutes timeout
+                )
 
-            if result.returncode != 0:
+            if returncode != 0:
+                if self._stop_event.is_set():
+                    # Killed by stop(); the minute is merged after a restart
+                    if temp_output.exists():
+                        temp_output.unlink()
+                    return False
                 logger.error(
-                    f"[{self.name}] FFmpeg merge failed (return code: {result.returncode})"
+                    "[%s] FFmpeg merge failed (return code: %s)", self.name, returncode
                 )
-                logger.error(f"[{self.name}] FFmpeg stderr: {result.stderr}")
+                logger.error("[%s] FFmpeg stderr: %s", self.name, stderr_tail)
                 # Log file list content for debugging
-                try:
-                    with open(filelist_path, "r", encoding="utf-8") as debug_f:
-                        logger.error(
-                            f"[{self.name}] File list content:\n{debug_f.read()}"
-                        )
-                except Exception:
-                    pass
+                logger.error("[%s] File list content:\n%s", self.name, filelist_content)
                 # Clean up temp file
                 if temp_output.exists():
                     temp_output.unlink()
@@ -284,40 +546,151 @@ class SegmentAggregator:
 
             # Atomic rename
             temp_output.rename(output_path)
-            logger.info(
-                f"[{self.name}] Successfully merged {len(valid_segments)} segments "
-                f"into {output_path.name}"
-            )
-
-            # Delete merged segments (only valid ones that were successfully merged)
-            deleted_count = 0
-            for segment in valid_segments:
-                try:
-                    segment.unlink()
-                    deleted_count += 1
-                except Exception as e:
-                    logger.warning(
-                        f"[{self.name}] Failed to delete segment {segment.name}: {e}"
-                    )
-
-            logger.debug(
-                f"[{self.name}] Deleted {deleted_count}/{len(valid_segments)} merged segments"
-            )
-
+            self._finish_merge(valid_segments, output_path)
             return True
 
         except subprocess.TimeoutExpired:
-            logger.error(f"[{self.name}] FFmpeg merge timed out")
+            logger.error("[%s] FFmpeg merge timed out", self.name)
             return False
         except Exception as e:
-            logger.error(f"[{self.name}] Error during merge: {e}", exc_info=True)
+            logger.error("[%s] Error during merge: %s", self.name, e, exc_info=True)
             return False
-        finally:
-            # Clean up filelist
+
+    def _partial_path(self, output_path: Path) -> Path:
+        """Temporary path a merge writes to before renaming into place"""
+        return output_path.with_name(f"{output_path.stem}.partial{self._suffix}")
+
+    def _remove_stale_partials(self) -> None:
+        """Delete partial merge outputs left behind by a crash"""
+        # Any container, in case segment_format changed since the crash
+        for partial in self.merged_dir.glob("*.partial.*"):
+            try:
+                partial.unlink()
+                logger.info(
+                    "[%s] Removed stale partial merge: %s", self.name, partial.name
+                )
+            except OSError as e:
+                logger.warning(
+                    "[%s] Could not remove partial merge %s: %s",
+                    self.name,
+                    partial.name,
+                    e,
+                )
+
+    def _finish_merge(self, segments: list[Path], output_path: Path) -> None:
+        """Log a completed merge and delete the merged segments"""
+        logger.info(
+            "[%s] Successfully merged %s segments into %s",
+            self.name,
+            len(segments),
+            output_path.name,
+        )
+
+        # Delete merged segments (only valid ones that were successfully merged)
+        deleted_count = self._delete_segments(segments)
+
+        logger.debug(
+            "[%s] Deleted %s/%s merged segments",
+            self.name,
+            deleted_count,
+            len(segments),
+        )
+
+    def _merge_ts_fast(self, segments: list[Path], output_path: Path) -> bool:
+        """Merge MPEG-TS segments by concatenating their bytes"""
+        # TS packets are self-contained and every segment starts on a
+        # keyframe, so a byte-level join equals FFmpeg's concat stream copy
+        temp_output = self._partial_path(output_path)
+        try:
+            out_fd = os.open(temp_output, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                for segment in segments:
+                    in_fd = os.open(segment, os.O_RDONLY)
+                    try:
+                        offset = 0
+                        while True:
+                            # Copied inside the kernel, no userspace buffers
+                            sent = os.sendfile(
+                                out_fd, in_fd, offset, self.SENDFILE_CHUNK
+                            )
+                            if sent == 0:
+                                break
+                            offset += sent
+                    finally:
+                        os.close(in_fd)
+            finally:
+                os.close(out_fd)
+
+            # Atomic rename
+            os.replace(temp_output, output_path)
+        except Exception as e:
+            logger.error("[%s] Error concatenating TS segments: %s", self.name, e)
             try:
-                filelist_path.unlink()
-            except Exception:
+                temp_output.unlink()
+            except OSError:
                 pass
+            return False
+
+        self._finish_merge(segments, output_path)
+        return True
+
+    def _update_minute_index(self, cutoff_timestamp: float) -> None:
+        """Index segments that became older than cutoff, drop vanished ones"""
+        present_names = set()
+        new_segments = []
+        with os.scandir(self.segments_dir) as entries:
+            for entry in entries:
+                name = entry.name
+                if not name.endswith(self._suffix):
+                    continue
+                present_names.add(name)
+
+                # Indexed segments are already settled, no need to stat again
+                if name in self._indexed_names:
+                    continue
+
+                try:
+                    # Check file modification time
+                    if entry.stat().st_mtime < cutoff_timestamp:
+                        new_segments.append(Path(entry.path))
+                except FileNotFoundError:
+                    # Deleted between listing and stat
+                    present_names.discard(name)
+                except Exception as e:
+                    logger.warning(
+                        "[%s] Error checking segment %s: %s", self.name, name, e
+                    )
+
+        # Forget segments removed behind our back (e.g. by the cleaner)
+        vanished = self._indexed_names - present_names
+        if vanished:
+            self._indexed_names -= vanished
+            for time_key, (minute_start, indexed) in list(self._minute_index.items()):
+                remaining = [s for s in indexed if s.name not in vanished]
+                if remaining:
+                    self._minute_index[time_key] = (minute_start, remaining)
+                else:
+                    del self._minute_index[time_key]
+
+        # Group by minute; unparseable names are remembered so they are only
+        # reported once
+        for time_key, group in self._group_segments_by_minute(new_segments).items():
+            if time_key not in self._minute_index:
+                self._minute_index[time_key] = group
+                continue
+            indexed = self._minute_index[time_key][1]
+            indexed.extend(group[1])
+            indexed.sort(key=lambda p: p.name)
+        self._indexed_names.update(s.name for s in new_segments)
+
+        # Evict cached probe results for segments that are gone
+        self._probe_cache.prune(present_names)
+
+    def _forget_minute(self, time_key: str) -> None:
+        """Drop a processed minute from the index"""
+        _, segments = self._minute_index.pop(time_key, (None, []))
+        for segment in segments:
+            self._indexed_names.discard(segment.name)
 
     def _merge_old_segments(self) -> None:
         """Find and merge segments older than merge_delay"""
@@ -328,101 +701,213 @@ class SegmentAggregator:
         cutoff_time = datetime.now() - timedelta(seconds=self.merge_delay)
         cutoff_timestamp = cutoff_time.timestamp()
 
-        # Find all segments older than cutoff
-        old_segments = []
-        for segment_file in self.segments_dir.glob("*.mp4"):
-            try:
-                # Check file modification time
-                file_mtime = segment_file.stat().st_mtime
-                if file_mtime < cutoff_timestamp:
-                    old_segments.append(segment_file)
-            except Exception as e:
-                logger.warning(
-                    f"[{self.name}] Error checking segment {segment_file.name}: {e}"
-                )
+        # Pick up newly settled segments instead of regrouping everything
+        self._update_minute_index(cutoff_timestamp)
 
-        if not old_segments:
-            logger.debug(f"[{self.name}] No old segments to merge")
+        if not self._minute_index:
+            logger.debug("[%s] No old segments to merge", self.name)
+            self._probe_cache.save()
             return
 
-        # Group by minute
-        groups = self._group_segments_by_minute(old_segments)
-
         # Merge each group
-        merged_count = 0
-        for time_key, segments in groups.items():
+        # stop() replaces the pool with None once it has shut it down
+        merge_pool = self._merge_pool
+        pending = {}
+        for time_key, (minute_start, segments) in list(self._minute_index.items()):
             # 只合併「該分鐘的最後一秒 < cutoff_time」的分鐘
             # 例如：time_key = '20251108_1627'，檢查 16:27:59 是否 < cutoff_time
-            minute_end = datetime.strptime(time_key, "%Y%m%d_%H%M")
-            minute_end = minute_end.replace(second=59)
+            minute_end_ts = minute_start.timestamp() + 59
 
-            if minute_end.timestamp() >= cutoff_timestamp:
-                logger.debug(
-                    f"[{self.name}] Skipping incomplete minute: {time_key} "
-                    f"(end time {minute_end.strftime('%H:%M:%S')} >= {datetime.fromtimestamp(cutoff_timestamp).strftime('%H:%M:%S')})"
-                )
+            if minute_end_ts >= cutoff_timestamp:
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(
+                        "[%s] Skipping incomplete minute: %s (end time %s >= %s)",
+                        self.name,
+                        time_key,
+                        datetime.fromtimestamp(minute_end_ts).strftime("%H:%M:%S"),
+                        datetime.fromtimestamp(cutoff_timestamp).strftime("%H:%M:%S"),
+                    )
                 continue
 
-            # Output filename: YYYYMMDD_HHMM.mp4
-            output_filename = f"{time_key}.mp4"
+            # Output filename: YYYYMMDD_HHMM.mp4 (or .ts)
+            output_filename = f"{time_key}{self._suffix}"
             output_path = self.merged_dir / output_filename
 
             # Skip if already merged
             if output_path.exists():
                 logger.debug(
-                    f"[{self.name}] Merged file already exists: {output_filename}, "
-                    f"deleting {len(segments)} segments"
+                    "[%s] Merged file already exists: %s, deleting %s segments",
+                    self.name,
+                    output_filename,
+                    len(segments),
                 )
                 # Delete segments even if merged file exists (recovery case)
-                for segment in segments:
-                    try:
-                        segment.unlink()
-                    except Exception:
-                        pass
+                self._delete_segments(segments)
+                self._forget_minute(time_key)
                 continue
 
-            if self._merge_segments(segments, output_path):
+            if merge_pool is None or self._stop_event.is_set():
+                break
+
+            # Minute groups are independent, so merge them in parallel
+            try:
+                future = merge_pool.submit(self._merge_segments, segments, output_path)
+            except RuntimeError as e:
+                # The pool refuses new work once stop() or the interpreter
+                # has shut it down
+                logger.debug("[%s] Cannot schedule merge: %s", self.name, e)
+                break
+            pending[future] = time_key
+
+        # Failed minutes stay indexed and are retried next interval. result()
+        # also returns once stop() cancels a queued merge, which wait() would
+        # never report
+        merged_count = 0
+        for future, time_key in pending.items():
+            try:
+                merged = future.result()
+            except CancelledError:
+                # Cancelled by stop(); merged on the next start
+                continue
+            except Exception as e:
+                logger.error(
+                    "[%s] Error merging segments for %s: %s", self.name, time_key, e
+                )
+                continue
+            if merged:
                 merged_count += 1
+                self._forget_minute(time_key)
 
         if merged_count > 0:
-            logger.info(f"[{self.name}] Merged {merged_count} group(s) of segments")
+            logger.info("[%s] Merged %s group(s) of segments", self.name, merged_count)
+
+        self._probe_cache.save()
+
+    def _note_segment_written(self, name: str, now_ts: float) -> None:
+        """Schedule a scan for when a just-written segment becomes mergeable"""
+        if name and not name.endswith(self._suffix):
+            return
+
+        # The segment settles merge_delay after it was closed, and its minute
+        # can only be merged once the whole minute has settled
+        due = now_ts
+        filename_time = self._parse_filename_time(name) if name else None
+        if filename_time is not None:
+            due = max(due, filename_time.replace(second=59).timestamp())
+            key = name[:13]
+        else:
+            key = name
+        due += self.merge_delay + 1
+
+        self._pending_scans[key] = max(self._pending_scans.get(key, 0.0), due)
+
+    def _scan_due(self, now_ts: float, last_scan: float | None) -> bool:
+        """Check if a directory scan could find anything to merge"""
+        if self._watcher is None or last_scan is None:
+            return True
+
+        if any(due <= now_ts for due in self._pending_scans.values()):
+            return True
+
+        # Retry minutes that should have been merged already (failed merges)
+        if now_ts - last_scan >= self.merge_interval:
+            overdue_ts = now_ts - self.merge_delay - 59
+            return any(
+                minute_start.timestamp() < overdue_ts
+                for minute_start, _ in self._minute_index.values()
+            )
+
+        return False
 
     def _run_aggregator(self) -> None:
-        """Run aggregator periodically"""
+        """Run aggregator when new segments can be merged"""
+        # On Linux, wait for segments to be written instead of scanning the
+        # directory every merge_interval; fall back to polling elsewhere
+        self._watcher = DirectoryWatcher.create(self.segments_dir)
+        if self._watcher is not None:
+            # Segments closed shortly before the watch started produce no
+            # event, so scan once more after they have all settled
+            self._pending_scans[""] = time.time() + self.merge_delay + 60
+
         logger.info(
-            f"[{self.name}] Aggregator started: interval={self.merge_interval}s, "
-            f"delay={self.merge_delay}s"
+            "[%s] Aggregator started: interval=%ss, delay=%ss, mode=%s",
+            self.name,
+            self.merge_interval,
+            self.merge_delay,
+            "polling" if self._watcher is None else "inotify",
         )
 
-        while not self._stop_event.is_set():
-            try:
-                self._merge_old_segments()
-            except Exception as e:
-                logger.error(f"[{self.name}] Error in aggregator: {e}", exc_info=True)
+        last_scan = None
+        try:
+            while not self._stop_event.is_set():
+                now_ts = time.time()
+                if self._scan_due(now_ts, last_scan):
+                    try:
+                        self._merge_old_segments()
+                    except Exception as e:
+                        logger.error(
+                            "[%s] Error in aggregator: %s", self.name, e, exc_info=True
+                        )
+                    last_scan = now_ts
+                    # Anything due by now was settled for this scan
+                    self._pending_scans = {
+                        key: due
+                        for key, due in self._pending_scans.items()
+                        if due > now_ts
+                    }
+
+                if self._watcher is None:
+                    # Wait for next merge interval
+                    self._stop_event.wait(self.merge_interval)
+                    continue
+
+                # Sleep until the next pending minute settles or new segments
+                # are written, capped at merge_interval
+                timeout = float(self.merge_interval)
+                if self._pending_scans:
+                    next_due = min(self._pending_scans.values())
+                    timeout = min(timeout, max(0.0, next_due - time.time()))
 
-            # Wait for next merge interval
-            self._stop_event.wait(self.merge_interval)
+                for name in self._watcher.wait(timeout):
+                    self._note_segment_written(name, time.time())
+        finally:
+            if self._watcher is not None:
+                self._watcher.close()
 
     def start(self) -> None:
         """Start aggregator in a separate thread"""
         if self._thread is not None and self._thread.is_alive():
-            logger.warning(f"[{self.name}] Aggregator already running")
+            logger.warning("[%s] Aggregator already running", self.name)
             return
 
         self._stop_event.clear()
+        # stop() shuts the merge pool down, so a restart needs a fresh one
+        if self._merge_pool is None:
+            self._merge_pool = self._new_merge_pool()
         self._thread = threading.Thread(target=self._run_aggregator, daemon=True)
         self._thread.start()
-        logger.info(f"[{self.name}] Aggregator thread started")
+        logger.info("[%s] Aggregator thread started", self.name)
 
     def stop(self) -> None:
         """Stop aggregator gracefully"""
-        logger.info(f"[{self.name}] Stopping aggregator...")
+        logger.info("[%s] Stopping aggregator...", self.name)
         self._stop_event.set()
+        if self._watcher is not None:
+            self._watcher.wake()
+
+        # Drop queued merges and kill running ones, so pool threads don't
+        # keep the interpreter alive after the join below gives up
+        if self._merge_pool is not None:
+            self._merge_pool.shutdown(wait=False, cancel_futures=True)
+            self._merge_pool = None
+        with self._merge_processes_lock:
+            for process in self._merge_processes:
+                process.kill()
 
         if self._thread is not None:
             self._thread.join(timeout=10)
 
-        logger.info(f"[{self.name}] Aggregator stopped")
+        logger.info("[%s] Aggregator stopped", self.name)
 
     def is_running(self) -> bool:
         """Check if aggregator is running"""
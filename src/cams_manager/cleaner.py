@@ -1,14 +1,44 @@
 """Old recording files cleaner"""
 
+import ctypes
+import ctypes.util
 import logging
+import os
+import platform
+import sys
 import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from itertools import repeat
 from pathlib import Path
 
 
 logger = logging.getLogger(__name__)
 
 
+# unlinkat() lets batches be deleted relative to an open directory fd
+_UNLINK_DIR_FD = os.unlink in os.supports_dir_fd
+
+# ioprio_set(2) has no libc wrapper, so it is called by syscall number
+_SYS_IOPRIO_SET = {
+    "x86_64": 251,
+    "i386": 289,
+    "i686": 289,
+    "aarch64": 30,
+    "armv7l": 314,
+    "armv6l": 314,
+}
+# Containers a recording directory can hold; segment_format may have changed
+SEGMENT_SUFFIXES = (".mp4", ".ts")
+PARTIAL_SUFFIXES = tuple(f".partial{suffix}" for suffix in SEGMENT_SUFFIXES)
+
+IOPRIO_WHO_PROCESS = 1  # With a thread id, applies to that thread only
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+CLEANER_NICENESS = 10
+
+
 class RecordingCleaner:
     """Periodically cleans old recording files"""
 
@@ -18,123 +48,264 @@ class RecordingCleaner:
         retention_days: int,
         merge_delay: int = 120,
         check_interval: int = 3600,  # 1 hour
+        segment_format: str = "mp4",
     ):
         self.recording_dirs = recording_dirs
         self.retention_days = retention_days
         self.merge_delay = merge_delay
         self.check_interval = check_interval
+        # Extension of both segments and merged files
+        self.segment_format = segment_format
 
         self._thread: threading.Thread | None = None
         self._stop_event = threading.Event()
 
     def _parse_segment_time_key(self, filename: str) -> str | None:
         """Extract time key (YYYYMMDD_HHMM) from segment filename"""
-        try:
-            # Remove extension
-            name_without_ext = filename.rsplit(".", 1)[0]
-            # Parse datetime
-            dt = datetime.strptime(name_without_ext, "%Y%m%d_%H%M%S")
-            # Return minute-level key
-            return dt.strftime("%Y%m%d_%H%M")
-        except ValueError:
+        # Fixed-width YYYYMMDD_HHMMSS.<ext>, so slice instead of strptime
+        if (
+            len(filename) < 16
+            or filename[8] != "_"
+            or filename[15] != "."
+            or not (filename[:8].isdigit() and filename[9:15].isdigit())
+        ):
             return None
+        return filename[:13]
 
-    def _clean_old_files(self) -> None:
-        """Remove files older than retention period"""
-        cutoff_time = datetime.now() - timedelta(days=self.retention_days)
-        cutoff_timestamp = cutoff_time.timestamp()
+    def _lower_priority(self) -> None:
+        """Deprioritize the calling thread's CPU and disk access (Linux only)"""
+        # Bulk deletes shouldn't starve the recorders' FFmpeg writes
+        if not sys.platform.startswith("linux"):
+            return
 
-        total_deleted = 0
-        total_freed = 0
+        tid = threading.get_native_id()
+        try:
+            # On Linux niceness is per thread when given a thread id
+            os.setpriority(os.PRIO_PROCESS, tid, CLEANER_NICENESS)
+        except OSError as e:
+            logger.debug("Could not lower cleaner CPU priority: %s", e)
 
-        for recording_dir in self.recording_dirs:
-            if not recording_dir.exists():
-                logger.warning(f"Recording directory does not exist: {recording_dir}")
-                continue
+        syscall_nr = _SYS_IOPRIO_SET.get(platform.machine())
+        if syscall_nr is None:
+            return
+        try:
+            libc = ctypes.CDLL(
+                ctypes.util.find_library("c") or "libc.so.6", use_errno=True
+            )
+            ioprio = IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT
+            if libc.syscall(syscall_nr, IOPRIO_WHO_PROCESS, tid, ioprio) < 0:
+                errno = ctypes.get_errno()
+                logger.debug(
+                    "Could not lower cleaner IO priority: %s", os.strerror(errno)
+                )
+        except (OSError, AttributeError) as e:
+            logger.debug("Could not lower cleaner IO priority: %s", e)
+
+    def _unlink_batch(self, dir_path: str, names: list[str]) -> list[str]:
+        """Delete names inside dir_path, returning the ones removed"""
+        removed = []
+        dir_fd = None
+        if _UNLINK_DIR_FD and names:
+            try:
+                dir_fd = os.open(dir_path, os.O_RDONLY | os.O_DIRECTORY)
+            except OSError as e:
+                logger.error("Cannot open directory %s: %s", dir_path, e)
+                return removed
+        try:
+            for name in names:
+                try:
+                    if dir_fd is not None:
+                        os.unlink(name, dir_fd=dir_fd)
+                    else:
+                        os.unlink(os.path.join(dir_path, name))
+                    removed.append(name)
+                except FileNotFoundError:
+                    # Already deleted, e.g. by the aggregator
+                    pass
+                except Exception as e:
+                    logger.error(
+                        "Error deleting file %s: %s", os.path.join(dir_path, name), e
+                    )
+        finally:
+            if dir_fd is not None:
+                os.close(dir_fd)
+
+        return removed
 
-            merged_dir = recording_dir / "merged"
-            segments_dir = recording_dir / "segments"
+    def _clean_one_dir(
+        self, recording_dir: Path, cutoff_timestamp: float, orphan_cutoff_ts: float
+    ) -> tuple[int, int]:
+        """Clean one camera's recordings, returning (files deleted, bytes freed)"""
+        # Files in a container no longer recorded are never merged again
+        current_suffix = f".{self.segment_format}"
 
-            # Clean merged files
-            if merged_dir.exists():
-                logger.debug(f"Scanning merged directory: {merged_dir}")
-                for file_path in merged_dir.glob("*.mp4"):
+        deleted = 0
+        freed = 0
+
+        # Plain string paths; each directory is checked with a single stat
+        rd = os.fspath(recording_dir)
+        if not os.path.isdir(rd):
+            logger.warning("Recording directory does not exist: %s", recording_dir)
+            return deleted, freed
+
+        merged_dir = os.path.join(rd, "merged")
+        segments_dir = os.path.join(rd, "segments")
+        merged_exists = os.path.isdir(merged_dir)
+        segments_exists = os.path.isdir(segments_dir)
+
+        # Names of merged files kept by this pass, used to match segments
+        surviving_merged: set[str] = set()
+
+        # Clean merged files
+        if merged_exists:
+            logger.debug("Scanning merged directory: %s", merged_dir)
+            with os.scandir(merged_dir) as entries:
+                for entry in entries:
+                    name = entry.name
+                    # Merges in progress are managed by the aggregator
+                    if not name.endswith(SEGMENT_SUFFIXES) or name.endswith(
+                        PARTIAL_SUFFIXES
+                    ):
+                        continue
                     try:
-                        file_mtime = file_path.stat().st_mtime
+                        # One stat gives both mtime and size
+                        st = entry.stat()
+                        file_mtime = st.st_mtime
+                        file_size = st.st_size
                         if file_mtime < cutoff_timestamp:
-                            file_size = file_path.stat().st_size
-                            file_path.unlink()
-                            total_deleted += 1
-                            total_freed += file_size
+                            os.unlink(entry.path)
+                            deleted += 1
+                            freed += file_size
                             logger.info(
-                                f"Deleted old merged file: {file_path.name} "
-                                f"(size: {file_size / 1024 / 1024:.2f} MB)"
+                                "Deleted old merged file: %s (size: %.2f MB)",
+                                name,
+                                file_size / 1024 / 1024,
                             )
+                        else:
+                            surviving_merged.add(name)
                     except Exception as e:
-                        logger.error(f"Error deleting file {file_path}: {e}")
-
-            # Clean segments only if corresponding merged file exists
-            if segments_dir.exists() and merged_dir.exists():
-                logger.debug(f"Scanning segments directory: {segments_dir}")
+                        logger.error("Error deleting file %s: %s", entry.path, e)
 
-                # Build set of existing merged files (without extension)
-                merged_files = {f.stem for f in merged_dir.glob("*.mp4")}
+        # Clean segments only if corresponding merged file exists
+        if segments_exists and merged_exists:
+            logger.debug("Scanning segments directory: %s", segments_dir)
 
-                for file_path in segments_dir.glob("*.mp4"):
+            # Merged segments are collected during the scan and deleted in one
+            # batch afterwards, so the listing isn't mutated while it's read
+            to_delete: dict[str, int] = {}
+            with os.scandir(segments_dir) as entries:
+                for entry in entries:
+                    name = entry.name
+                    if not name.endswith(SEGMENT_SUFFIXES):
+                        continue
+                    suffix = name[name.rindex(".") :]
                     try:
-                        # Get the time key for this segment
-                        time_key = self._parse_segment_time_key(file_path.name)
+                        # Get the time key for this segment; regular names
+                        # skip the method call
+                        if (
+                            name[15:] == suffix
+                            and name[8] == "_"
+                            and name[:8].isdigit()
+                            and name[9:15].isdigit()
+                        ):
+                            time_key = name[:13]
+                        else:
+                            time_key = self._parse_segment_time_key(name)
                         if time_key is None:
-                            logger.warning(
-                                f"Cannot parse segment filename: {file_path.name}"
-                            )
+                            logger.warning("Cannot parse segment filename: %s", name)
                             continue
 
+                        st = entry.stat()
+
                         # Only delete if corresponding merged file exists
-                        if time_key in merged_files:
-                            file_size = file_path.stat().st_size
-                            file_path.unlink()
-                            total_deleted += 1
-                            total_freed += file_size
-                            logger.debug(
-                                f"Deleted merged segment: {file_path.name} "
-                                f"(merged file exists: {time_key}.mp4)"
-                            )
+                        if f"{time_key}{suffix}" in surviving_merged:
+                            to_delete[name] = st.st_size
+                        elif (
+                            suffix != current_suffix and st.st_mtime < cutoff_timestamp
+                        ):
+                            # Left over from another segment_format, so the
+                            # aggregator will never merge it
+                            to_delete[name] = st.st_size
                         else:
                             # Check if segment is very old (potential orphan)
-                            file_mtime = file_path.stat().st_mtime
-                            orphan_cutoff = datetime.now() - timedelta(days=1)
-                            if file_mtime < orphan_cutoff.timestamp():
+                            if st.st_mtime < orphan_cutoff_ts:
                                 logger.warning(
-                                    f"Found old unmerged segment: {file_path.name} "
-                                    f"(no corresponding merged file)"
+                                    "Found old unmerged segment: %s (no corresponding merged file)",
+                                    name,
                                 )
                     except Exception as e:
-                        logger.error(f"Error processing segment {file_path}: {e}")
+                        logger.error("Error processing segment %s: %s", entry.path, e)
+
+            for name in self._unlink_batch(segments_dir, list(to_delete)):
+                deleted += 1
+                freed += to_delete[name]
+                logger.debug("Deleted segment: %s", name)
+
+        return deleted, freed
+
+    def _clean_old_files(self) -> None:
+        """Remove files older than retention period"""
+        cutoff_time = datetime.now() - timedelta(days=self.retention_days)
+        cutoff_timestamp = cutoff_time.timestamp()
+        # Unmerged segments older than a day are reported as orphans
+        now_ts = time.time()
+        orphan_cutoff_ts = now_ts - 86400.0
+
+        # Directories are independent and cleaning them is syscall-bound, so
+        # scan several cameras at once
+        total_deleted = 0
+        total_freed = 0
+        if self.recording_dirs:
+            with ThreadPoolExecutor(
+                max_workers=min(8, len(self.recording_dirs)),
+                initializer=self._lower_priority,
+            ) as executor:
+                results = list(
+                    executor.map(
+                        self._clean_one_dir,
+                        self.recording_dirs,
+                        repeat(cutoff_timestamp),
+                        repeat(orphan_cutoff_ts),
+                    )
+                )
+            for deleted, freed in results:
+                total_deleted += deleted
+                total_freed += freed
 
         if total_deleted > 0:
             logger.info(
-                f"Cleanup completed: {total_deleted} files deleted, "
-                f"{total_freed / 1024 / 1024 / 1024:.2f} GB freed"
+                "Cleanup completed: %s files deleted, %.2f GB freed",
+                total_deleted,
+                total_freed / 1024 / 1024 / 1024,
             )
         else:
             logger.debug("No old files to clean")
 
     def _run_cleaner(self) -> None:
         """Run cleaner periodically"""
+        self._lower_priority()
         logger.info(
-            f"Cleaner started: checking every {self.check_interval}s, "
-            f"retention: {self.retention_days} days"
+            "Cleaner started: checking every %ss, retention: %s days",
+            self.check_interval,
+            self.retention_days,
         )
 
+        # Run on a fixed cadence rather than cleanup duration + interval
+        next_tick = time.monotonic()
         while not self._stop_event.is_set():
             try:
                 self._clean_old_files()
             except Exception as e:
-                logger.error(f"Error in cleaner: {e}", exc_info=True)
+                logger.error("Error in cleaner: %s", e, exc_info=True)
 
-            # Wait for next check interval
-            self._stop_event.wait(self.check_interval)
+            # Wait for next check interval; if a cleanup overran it, run again
+            # now instead of trying to catch up on missed ticks
+            next_tick += self.check_interval
+            delay = next_tick - time.monotonic()
+            if delay < 0:
+                next_tick = time.monotonic()
+                continue
+            self._stop_event.wait(delay)
 
     def start(self) -> None:
         """Start cleaner in a separate thread"""
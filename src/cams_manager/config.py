@@ -1,12 +1,17 @@
 """Configuration loader for cams-manager"""
 
 from pathlib import Path
+from typing import Literal
 
 import yaml
 from pydantic import BaseModel, Field
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
+# libyaml's loader when PyYAML was built with it
+_YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
 class Camera(BaseModel, extra="forbid"):
     """Camera configuration model"""
 
@@ -20,13 +25,25 @@ class Recording(BaseModel):
 
     segment_duration: int = Field(default=2, description="Segment duration in seconds")
     retention_days: int = Field(default=7, description="Retention period in days")
-    reconnect_delay: int = Field(default=5, description="Reconnect delay in seconds")
+    reconnect_delay: int = Field(
+        default=5,
+        description="Initial reconnect delay in seconds, doubled on repeated failures",
+    )
     merge_interval: int = Field(
         default=30, description="Merge check interval in seconds"
     )
     merge_delay: int = Field(
         default=120, description="Minimum delay before merging segments in seconds"
     )
+    max_concurrent_merges: int = Field(
+        default=2,
+        ge=1,
+        description="Maximum merge FFmpeg processes across all cameras",
+    )
+    segment_format: Literal["mp4", "ts"] = Field(
+        default="mp4",
+        description="Segment container; ts segments are merged without FFmpeg",
+    )
 
 
 class FFmpeg(BaseModel):
@@ -34,6 +51,15 @@ class FFmpeg(BaseModel):
 
     rtbufsize: str = Field(default="100M", description="RT buffer size")
     timeout: int = Field(default=5000000, description="Stream timeout in microseconds")
+    merge_threads: int = Field(
+        default=1, description="Threads per FFmpeg process when merging segments"
+    )
+    audio_enabled: bool = Field(
+        default=True, description="Record audio; disable for audio-less cameras"
+    )
+    pin_core: bool = Field(
+        default=False, description="Pin each camera's FFmpeg to one CPU core"
+    )
 
 
 class Config(BaseSettings):
@@ -59,7 +85,8 @@ class Config(BaseSettings):
         if not config_path.exists():
             raise FileNotFoundError(f"Config file not found: {config_path}")
 
-        with config_path.open() as f:
-            data = yaml.safe_load(f)
+        # Bytes let the loader skip decoding into a str first
+        with config_path.open("rb") as f:
+            data = yaml.load(f, Loader=_YamlLoader)
 
         return cls.model_validate(data)
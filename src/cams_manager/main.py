@@ -4,7 +4,7 @@ import argparse
 import logging
 import signal
 import sys
-import time
+import threading
 from pathlib import Path
 
 from .aggregator import SegmentAggregator
@@ -25,6 +25,8 @@ class CamsManager:
         self.aggregators: list[SegmentAggregator] = []
         self.cleaner: RecordingCleaner | None = None
         self._shutdown = False
+        # Set by signal handlers or stop(); run() blocks on it
+        self._shutdown_event = threading.Event()
 
     def setup_recorders(self) -> None:
         """Initialize recorders for all cameras"""
@@ -36,6 +38,7 @@ class CamsManager:
                 segment_duration=self.config.recording.segment_duration,
                 reconnect_delay=self.config.recording.reconnect_delay,
                 ffmpeg_options=self.config.ffmpeg.model_dump(),
+                segment_format=self.config.recording.segment_format,
             )
             self.recorders.append(recorder)
 
@@ -43,6 +46,9 @@ class CamsManager:
 
     def setup_aggregators(self) -> None:
         """Initialize aggregators for all cameras"""
+        merge_semaphore = threading.BoundedSemaphore(
+            self.config.recording.max_concurrent_merges
+        )
         for camera in self.config.cameras:
             base_dir = Path(camera.output_dir)
             segments_dir = base_dir / "segments"
@@ -54,6 +60,9 @@ class CamsManager:
                 merged_dir=merged_dir,
                 merge_interval=self.config.recording.merge_interval,
                 merge_delay=self.config.recording.merge_delay,
+                ffmpeg_threads=self.config.ffmpeg.merge_threads,
+                merge_semaphore=merge_semaphore,
+                segment_format=self.config.recording.segment_format,
             )
             self.aggregators.append(aggregator)
 
@@ -66,6 +75,7 @@ class CamsManager:
             recording_dirs=recording_dirs,
             retention_days=self.config.recording.retention_days,
             merge_delay=self.config.recording.merge_delay,
+            segment_format=self.config.recording.segment_format,
         )
         logger.info("Initialized recording cleaner")
 
@@ -93,6 +103,7 @@ class CamsManager:
             return
 
         self._shutdown = True
+        self._shutdown_event.set()
         logger.info("Shutting down cams-manager...")
 
         # Stop all recorders
@@ -111,9 +122,9 @@ class CamsManager:
 
     def run(self) -> None:
         """Run the application until interrupted"""
-        # Setup signal handlers
-        signal.signal(signal.SIGTERM, lambda sig, frame: self.stop())
-        signal.signal(signal.SIGINT, lambda sig, frame: self.stop())
+        # Setup signal handlers; shutdown itself runs on the main thread below
+        signal.signal(signal.SIGTERM, lambda sig, frame: self._shutdown_event.set())
+        signal.signal(signal.SIGINT, lambda sig, frame: self._shutdown_event.set())
 
         # Setup and start services
         self.setup_recorders()
@@ -123,8 +134,7 @@ class CamsManager:
 
         # Keep running until shutdown
         try:
-            while not self._shutdown:
-                time.sleep(1)
+            self._shutdown_event.wait()
         except KeyboardInterrupt:
             logger.info("Received keyboard interrupt")
         finally:
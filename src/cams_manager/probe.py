@@ -0,0 +1,205 @@
+"""Segment probing helpers and persistent probe cache"""
+
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+from collections.abc import Callable, Iterator
+from pathlib import Path
+from typing import Any
+
+
+logger = logging.getLogger(__name__)
+
+
+ProbeResult = dict[str, Any]
+
+
+def _iter_boxes(
+    buf: mmap.mmap, start: int, end: int
+) -> Iterator[tuple[bytes, int, int]]:
+    """Yield (type, payload_start, box_end) for MP4 boxes in buf[start:end]"""
+    offset = start
+    while offset + 8 <= end:
+        size, box_type = struct.unpack_from(">I4s", buf, offset)
+        header_size = 8
+        if size == 1:
+            # 64-bit largesize follows the type field
+            if offset + 16 > end:
+                return
+            (size,) = struct.unpack_from(">Q", buf, offset + 8)
+            header_size = 16
+        elif size == 0:
+            # Box extends to the end of its parent
+            size = end - offset
+
+        if size < header_size or offset + size > end:
+            # Truncated box, e.g. a segment that is still being written
+            return
+
+        yield box_type, offset + header_size, offset + size
+        offset += size
+
+
+def _find_box(
+    buf: mmap.mmap, start: int, end: int, box_type: bytes
+) -> tuple[int, int] | None:
+    """Find first child box of given type, returning (payload_start, box_end)"""
+    for child_type, child_start, child_end in _iter_boxes(buf, start, end):
+        if child_type == box_type:
+            return child_start, child_end
+    return None
+
+
+def _is_video_trak(buf: mmap.mmap, start: int, end: int) -> bool:
+    """Check if trak box has a video handler (trak/mdia/hdlr == 'vide')"""
+    mdia = _find_box(buf, start, end, b"mdia")
+    if mdia is None:
+        return False
+
+    hdlr = _find_box(buf, *mdia, b"hdlr")
+    if hdlr is None or hdlr[0] + 12 > hdlr[1]:
+        return False
+
+    # hdlr payload: version/flags (4), pre_defined (4), handler_type (4)
+    return buf[hdlr[0] + 8 : hdlr[0] + 12] == b"vide"
+
+
+def probe_mp4_fast(path: str | Path) -> tuple[bool, float] | None:
+    """Read (has_video, duration) straight from the MP4 moov box
+
+    Returns None when the file cannot be parsed (no moov box yet, truncated
+    boxes, not an MP4), in which case callers should fall back to ffprobe.
+    """
+    try:
+        with (
+            open(path, "rb") as f,
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf,
+        ):
+            moov = _find_box(buf, 0, len(buf), b"moov")
+            if moov is None:
+                return None
+
+            duration = None
+            has_video = False
+            for box_type, start, end in _iter_boxes(buf, *moov):
+                if box_type == b"mvhd":
+                    # mvhd payload: version/flags (4), creation/modification
+                    # times (4+4 or 8+8), timescale (4), duration (4 or 8)
+                    if buf[start] == 1:
+                        timescale, ticks = struct.unpack_from(">IQ", buf, start + 20)
+                    else:
+                        timescale, ticks = struct.unpack_from(">II", buf, start + 12)
+                    if timescale:
+                        duration = ticks / timescale
+                elif box_type == b"trak" and _is_video_trak(buf, start, end):
+                    has_video = True
+
+            if duration is None:
+                return None
+
+            return has_video, duration
+    except (OSError, ValueError, struct.error):
+        # ValueError: empty file cannot be memory-mapped
+        return None
+
+
+class ProbeCache:
+    """Persistent cache of validated segment probe results
+
+    Entries are keyed by segment file name and invalidated when the file's
+    size or mtime changes, so only new or modified segments are probed.
+    """
+
+    def __init__(
+        self,
+        cache_path: str | Path,
+        probe: Callable[[Path], ProbeResult | None],
+    ):
+        self.cache_path = Path(cache_path)
+        self.probe = probe
+
+        self._entries: dict[str, dict[str, Any]] = {}
+        self._dirty = False
+        # get_or_probe may be called from several probe worker threads
+        self._lock = threading.Lock()
+
+        self._load()
+
+    def _load(self) -> None:
+        """Load cache entries from disk, starting empty on any error"""
+        if not self.cache_path.exists():
+            return
+
+        try:
+            with self.cache_path.open("r", encoding="utf-8") as f:
+                data = json.load(f)
+            if isinstance(data, dict):
+                self._entries = data
+        except Exception as e:
+            logger.warning("Could not load probe cache %s: %s", self.cache_path, e)
+            self._entries = {}
+
+    def get_or_probe(
+        self,
+        segment: Path,
+        stat_result: os.stat_result | None = None,
+        probe: Callable[[Path], ProbeResult | None] | None = None,
+    ) -> ProbeResult | None:
+        """Return cached probe result for segment, probing on cache miss
+
+        probe replaces the cache's probe function for this call.
+        """
+        if stat_result is None:
+            stat_result = segment.stat()
+
+        with self._lock:
+            entry = self._entries.get(segment.name)
+        if (
+            entry is not None
+            and entry.get("size") == stat_result.st_size
+            and entry.get("mtime_ns") == stat_result.st_mtime_ns
+        ):
+            return entry["result"]
+
+        result = (probe or self.probe)(segment)
+        if result is not None:
+            # Only valid results are cached; invalid segments are re-probed
+            with self._lock:
+                self._entries[segment.name] = {
+                    "size": stat_result.st_size,
+                    "mtime_ns": stat_result.st_mtime_ns,
+                    "result": result,
+                }
+                self._dirty = True
+
+        return result
+
+    def prune(self, existing_names: set[str]) -> None:
+        """Evict entries whose segment files no longer exist"""
+        with self._lock:
+            stale = [name for name in self._entries if name not in existing_names]
+            for name in stale:
+                del self._entries[name]
+            if stale:
+                self._dirty = True
+
+    def save(self) -> None:
+        """Write cache to disk atomically if it changed"""
+        with self._lock:
+            if not self._dirty:
+                return
+            entries = dict(self._entries)
+            self._dirty = False
+
+        temp_path = self.cache_path.with_suffix(self.cache_path.suffix + ".tmp")
+        try:
+            with temp_path.open("w", encoding="utf-8") as f:
+                json.dump(entries, f)
+            os.replace(temp_path, self.cache_path)
+        except Exception as e:
+            logger.warning("Could not save probe cache %s: %s", self.cache_path, e)
+            with self._lock:
+                self._dirty = True
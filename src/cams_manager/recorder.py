@@ -1,9 +1,16 @@
 """RTSP stream recorder using FFmpeg"""
 
+import asyncio
+import concurrent.futures
 import logging
+import os
+import random
+import shutil
 import subprocess
 import threading
 import time
+import zlib
+from collections import deque
 from pathlib import Path
 from typing import Any
 
@@ -11,11 +18,35 @@ from typing import Any
 logger = logging.getLogger(__name__)
 
 
+_event_loop: asyncio.AbstractEventLoop | None = None
+_event_loop_lock = threading.Lock()
+
+
+def _get_event_loop() -> asyncio.AbstractEventLoop:
+    """Return the event loop shared by all recorders, starting it if needed"""
+    # One thread supervises every camera; asyncio watches FFmpeg children
+    # through pidfds where available
+    global _event_loop
+    with _event_loop_lock:
+        if _event_loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=loop.run_forever, name="recorder-loop", daemon=True
+            ).start()
+            _event_loop = loop
+        return _event_loop
+
+
 class CameraRecorder:
     """Records RTSP stream from a single camera using FFmpeg"""
 
     PERIODIC_RESTART_INTERVAL = 18 * 60  # 18 minutes
     HEALTH_CHECK_INTERVAL = 5  # Check health every 5 seconds
+    STDERR_TAIL_LINES = 20  # FFmpeg stderr lines kept for the exit log
+    STDERR_READ_SIZE = 64 * 1024
+    STDERR_LOG_BYTES = 4096  # Most of the stderr tail decoded for the exit log
+    RECONNECT_MAX_DELAY = 60  # Cap for the exponential reconnect backoff
+    RECONNECT_RESET_AFTER = 60  # A run this long resets the backoff
 
     def __init__(
         self,
@@ -25,6 +56,7 @@ class CameraRecorder:
         segment_duration: int,
         reconnect_delay: int,
         ffmpeg_options: dict[str, Any],
+        segment_format: str = "mp4",
     ):
         self.name = name
         self.rtsp_url = rtsp_url
@@ -34,21 +66,61 @@ class CameraRecorder:
         self.segment_duration = segment_duration
         self.reconnect_delay = reconnect_delay
         self.ffmpeg_options = ffmpeg_options
+        # File extension of segments; "ts" is muxed as MPEG-TS
+        self.segment_format = segment_format
+
+        self._process: asyncio.subprocess.Process | None = None
+        self._last_stderr_lines: deque[bytes] = deque(maxlen=self.STDERR_TAIL_LINES)
+        # Newest segment seen by the last health check scan
+        self._last_segment_path: str | None = None
 
-        self._process: subprocess.Popen | None = None
-        self._thread: threading.Thread | None = None
-        self._stop_event = threading.Event()
+        # Recording runs as a task on the shared recorder event loop
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._future: concurrent.futures.Future | None = None
+        self._task: asyncio.Task | None = None
 
         # Create output directory if it doesn't exist
         self.output_dir.mkdir(parents=True, exist_ok=True)
 
+        # Resolved once so reconnects don't search PATH on every spawn
+        self._ffmpeg_bin = shutil.which("ffmpeg")
+        if self._ffmpeg_bin is None:
+            logger.error(f"[{self.name}] ffmpeg not found in PATH")
+            self._ffmpeg_bin = "ffmpeg"
+
+        # strftime pattern FFmpeg expands into segment file names
+        self._output_pattern = os.fspath(
+            self.output_dir / f"%Y%m%d_%H%M%S.{self.segment_format}"
+        )
+        # Settings are fixed after construction, so every reconnect reuses it
+        self._ffmpeg_cmd = self._build_ffmpeg_command()
+
+        self._pinned_cpu = (
+            self._choose_cpu() if self.ffmpeg_options.get("pin_core") else None
+        )
+
+    def _choose_cpu(self) -> int | None:
+        """Pick the CPU this camera's FFmpeg is pinned to (Linux only)"""
+        if not hasattr(os, "sched_setaffinity"):
+            logger.warning(f"[{self.name}] pin_core is not supported on this platform")
+            return None
+        # crc32 rather than hash() so a camera keeps its CPU across runs
+        cpus = sorted(os.sched_getaffinity(0))
+        return cpus[zlib.crc32(self.name.encode()) % len(cpus)]
+
     def _build_ffmpeg_command(self) -> list[str]:
         """Build FFmpeg command with all required parameters"""
 
-        output_pattern = str(self.output_dir / "%Y%m%d_%H%M%S.mp4")
+        # Audio is transcoded to AAC; without it there's nothing to encode
+        if self.ffmpeg_options.get("audio_enabled", True):
+            audio_args = ["-c:a", "aac"]
+        else:
+            audio_args = ["-an"]
         return [
-            "ffmpeg",
+            self._ffmpeg_bin,
             "-nostdin",  # Don't read from stdin (prevents hanging in background)
+            "-loglevel",
+            "error",  # Keep stderr quiet; progress output is never used
             "-rtsp_transport",
             "tcp",
             "-rtbufsize",
@@ -59,14 +131,18 @@ class CameraRecorder:
             # Reconnection is handled by our health check mechanism instead
             "-use_wallclock_as_timestamps",
             "1",
+            # Fill in missing timestamps and drop corrupt packets
+            "-fflags",
+            "+genpts+discardcorrupt",
             "-i",
             self.rtsp_url,
+            # TS segments are merged by byte concatenation, so they keep
+            # continuous timestamps instead of restarting at zero
             "-reset_timestamps",
-            "1",
+            "0" if self.segment_format == "ts" else "1",
             "-c:v",
             "copy",
-            "-c:a",
-            "aac",
+            *audio_args,
             "-f",
             "segment",
             # 在整點時間切換 segment
@@ -79,7 +155,7 @@ class CameraRecorder:
             "-segment_time_delta",
             "0.05",
             "-segment_format",
-            "mp4",
+            "mpegts" if self.segment_format == "ts" else "mp4",
             "-strftime",
             "1",
             # 避免時間戳問題
@@ -88,7 +164,7 @@ class CameraRecorder:
             # 增加 muxing 佇列
             "-max_muxing_queue_size",
             "1024",
-            output_pattern,
+            self._output_pattern,
         ]
 
     def _get_latest_segment_mtime(self) -> float | None:
@@ -96,19 +172,47 @@ class CameraRecorder:
         if not self.output_dir.exists():
             return None
 
-        segments = list(self.output_dir.glob("*.mp4"))
-        if not segments:
+        # Names are %Y%m%d_%H%M%S, so the newest segment sorts last and only
+        # that one needs to be stat'd
+        suffix = f".{self.segment_format}"
+        latest_name = None
+        latest_path = None
+        with os.scandir(self.output_dir) as entries:
+            for entry in entries:
+                name = entry.name
+                if not name.endswith(suffix):
+                    continue
+                if latest_name is None or name > latest_name:
+                    latest_name = name
+                    latest_path = entry.path
+
+        if latest_path is None:
+            return None
+
+        try:
+            mtime = os.stat(latest_path).st_mtime
+        except FileNotFoundError:
+            # Removed by the aggregator after scanning
             return None
 
-        # Get the most recently modified file
-        latest = max(segments, key=lambda p: p.stat().st_mtime)
-        return latest.stat().st_mtime
+        self._last_segment_path = latest_path
+        return mtime
 
     def _check_ffmpeg_health(self, timeout: int) -> bool:
         """Check if FFmpeg is producing new files (health check)"""
-        if self._process is None or self._process.poll() is not None:
+        if self._process is None or self._process.returncode is not None:
             return False
 
+        # A recently written cached segment proves progress without a scan;
+        # the directory is only listed again once it goes stale
+        if self._last_segment_path is not None:
+            try:
+                cached_mtime = os.stat(self._last_segment_path).st_mtime
+            except FileNotFoundError:
+                cached_mtime = None
+            if cached_mtime is not None and time.time() - cached_mtime <= timeout:
+                return True
+
         # Check if new files are being created
         # Allow up to segment_duration * 3 seconds without new files before considering it hung
         latest_mtime = self._get_latest_segment_mtime()
@@ -128,135 +232,219 @@ class CameraRecorder:
 
         return True
 
-    def _terminate_process(self, reason: str = "terminating") -> None:
+    async def _terminate_process(self, reason: str = "terminating") -> None:
         """Terminate FFmpeg process gracefully, with fallback to kill if needed"""
         if self._process is None:
             return
 
-        if self._process.poll() is not None:
+        if self._process.returncode is not None:
             # Process already ended
             return
 
         try:
             self._process.terminate()
             try:
-                self._process.wait(timeout=5)
-            except subprocess.TimeoutExpired:
+                await asyncio.wait_for(self._process.wait(), timeout=5)
+            except TimeoutError:
                 logger.warning(f"[{self.name}] FFmpeg did not terminate, killing...")
                 self._process.kill()
-                self._process.wait()
+                await self._process.wait()
+        except ProcessLookupError:
+            # Exited before the signal was delivered
+            pass
         except Exception as e:
             logger.error(f"[{self.name}] Error {reason} FFmpeg process: {e}")
 
-    def _run_ffmpeg(self) -> None:
+    async def _drain_stderr(
+        self, stream: asyncio.StreamReader, tail: deque[bytes]
+    ) -> None:
+        """Read FFmpeg stderr until EOF, keeping only the last lines"""
+        # Without a reader FFmpeg blocks once the pipe buffer fills up.
+        # Progress lines end in \r, so split on both line endings
+        partial = b""
+        while chunk := await stream.read(self.STDERR_READ_SIZE):
+            lines = (partial + chunk).replace(b"\r", b"\n").split(b"\n")
+            partial = lines.pop()[-self.STDERR_READ_SIZE :]
+            tail.extend(line for line in lines if line)
+        if partial:
+            tail.append(partial)
+
+    async def _run_ffmpeg(self) -> None:
         """Run FFmpeg process with auto-reconnect and health monitoring"""
-        while not self._stop_event.is_set():
+        self._task = asyncio.current_task()
+        attempt = 0
+        try:
+            while True:
+                started = time.monotonic()
+                try:
+                    if await self._record_once():
+                        # Deliberate restart, reconnect right away
+                        attempt = 0
+                        continue
+                except Exception as e:
+                    logger.error(
+                        f"[{self.name}] Error in recording: {e}", exc_info=True
+                    )
+
+                if time.monotonic() - started >= self.RECONNECT_RESET_AFTER:
+                    attempt = 0
+                # Back off exponentially while the camera stays unreachable;
+                # the jitter keeps cameras from reconnecting in lockstep
+                cap = max(self.RECONNECT_MAX_DELAY, self.reconnect_delay)
+                delay = min(cap, self.reconnect_delay * 2**attempt)
+                delay -= random.uniform(0, delay * 0.2)
+                if self.reconnect_delay * 2**attempt < cap:
+                    attempt += 1
+                logger.info(f"[{self.name}] Reconnecting in {delay:.1f} seconds...")
+                # Cancelled immediately by stop()
+                await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            # stop() cancels the task; take FFmpeg down with it
+            await self._terminate_process("stopping recorder")
+            raise
+
+    async def _record_once(self) -> bool:
+        """Run one FFmpeg process, returning True if it was restarted on purpose"""
+        cmd = self._ffmpeg_cmd
+        # A new process starts with no known segment
+        self._last_segment_path = None
+        logger.info(f"[{self.name}] Starting FFmpeg recording...")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"[{self.name}] Command: {' '.join(cmd)}")
+
+        # The stderr tail is only ever logged at debug level
+        capture_stderr = logger.isEnabledFor(logging.DEBUG)
+        self._process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=subprocess.DEVNULL,  # Prevent stdin from causing hangs
+            stdout=subprocess.DEVNULL,  # Output goes to segment files
+            stderr=subprocess.PIPE if capture_stderr else subprocess.DEVNULL,
+            # Our fds are non-inheritable already; skipping the close pass
+            # keeps Popen on its posix_spawn path instead of fork + exec
+            close_fds=False,
+        )
+        if self._pinned_cpu is not None:
             try:
-                cmd = self._build_ffmpeg_command()
-                logger.info(f"[{self.name}] Starting FFmpeg recording...")
-                logger.debug(f"[{self.name}] Command: {' '.join(cmd)}")
-
-                self._process = subprocess.Popen(
-                    cmd,
-                    stdin=subprocess.DEVNULL,  # Prevent stdin from causing hangs
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    text=True,
-                )
+                os.sched_setaffinity(self._process.pid, {self._pinned_cpu})
+            except OSError as e:
+                logger.warning(f"[{self.name}] Could not pin FFmpeg to a CPU: {e}")
+        self._last_stderr_lines = deque(maxlen=self.STDERR_TAIL_LINES)
+        drain_task = None
+        if capture_stderr:
+            drain_task = asyncio.create_task(
+                self._drain_stderr(self._process.stderr, self._last_stderr_lines)
+            )
+        exit_task = asyncio.create_task(self._process.wait())
 
-                # Track process start time for periodic restart (19 min 50 sec = 1190 seconds)
-                # This prevents RTSP session timeout issues (typically 20 minutes)
-                process_start_time = time.time()
+        # Track process start time for periodic restart (19 min 50 sec = 1190 seconds)
+        # This prevents RTSP session timeout issues (typically 20 minutes)
+        process_start_time = time.time()
 
-                # Track last health check time
-                last_health_check = time.time()
+        # Track last health check time
+        last_health_check = time.time()
 
-                wait_for_reconnect = True
+        restarted = False
 
-                # Monitor the process
-                while not self._stop_event.is_set():
-                    if self._process.poll() is not None:
-                        # Process has ended
-                        stdout, stderr = self._process.communicate()
-                        logger.warning(
-                            f"[{self.name}] FFmpeg process ended. "
-                            f"Return code: {self._process.returncode}"
+        try:
+            # Monitor the process
+            while True:
+                # Sleep until the next health check or periodic restart, or
+                # until FFmpeg exits
+                next_deadline = min(
+                    last_health_check + self.HEALTH_CHECK_INTERVAL,
+                    process_start_time + self.PERIODIC_RESTART_INTERVAL,
+                )
+                await asyncio.wait(
+                    {exit_task}, timeout=max(0.0, next_deadline - time.time())
+                )
+                if exit_task.done():
+                    # Process has ended; let the drain reach EOF so the
+                    # stderr tail is complete
+                    if drain_task is not None:
+                        await asyncio.wait({drain_task}, timeout=1)
+                    logger.warning(
+                        f"[{self.name}] FFmpeg process ended. "
+                        f"Return code: {self._process.returncode}"
+                    )
+                    if self._last_stderr_lines:
+                        stderr_tail = b"\n".join(self._last_stderr_lines)
+                        # Bad bytes are replaced, never raised on
+                        stderr_tail = stderr_tail[-self.STDERR_LOG_BYTES :]
+                        logger.debug(
+                            f"[{self.name}] FFmpeg stderr: "
+                            f"{stderr_tail.decode(errors='replace')}"
                         )
-                        if stderr:
-                            logger.debug(
-                                f"[{self.name}] FFmpeg stderr: {stderr[-500:]}"
-                            )
-                        break
-
-                    current_time = time.time()
+                    break
 
-                    # Check if it's time for periodic restart (before RTSP session timeout)
-                    process_runtime = current_time - process_start_time
-                    if process_runtime >= self.PERIODIC_RESTART_INTERVAL:
-                        logger.info(
-                            f"[{self.name}] Periodic restarting: {process_runtime:.1f}/{self.PERIODIC_RESTART_INTERVAL:.1f} seconds"
-                        )
-                        self._terminate_process("periodic restart")
-                        wait_for_reconnect = False
-                        break
+                current_time = time.time()
 
-                    # Periodic health check
-                    if current_time - last_health_check >= self.HEALTH_CHECK_INTERVAL:
-                        if not self._check_ffmpeg_health(
-                            self.HEALTH_CHECK_INTERVAL * 2
-                        ):
-                            # FFmpeg appears to be hung, force restart
-                            logger.warning(
-                                f"[{self.name}] FFmpeg health check failed, "
-                                f"forcing restart..."
-                            )
-                            self._terminate_process("health check failure")
-                            wait_for_reconnect = False
-                            break
-                        last_health_check = current_time
-
-                    time.sleep(1)
-
-                # If we're not stopping, wait before reconnecting
-                if not self._stop_event.is_set() and wait_for_reconnect:
+                # Check if it's time for periodic restart (before RTSP session timeout)
+                process_runtime = current_time - process_start_time
+                if process_runtime >= self.PERIODIC_RESTART_INTERVAL:
                     logger.info(
-                        f"[{self.name}] Reconnecting in {self.reconnect_delay} seconds..."
+                        f"[{self.name}] Periodic restarting: {process_runtime:.1f}/{self.PERIODIC_RESTART_INTERVAL:.1f} seconds"
                     )
-                    self._stop_event.wait(self.reconnect_delay)
-
-            except Exception as e:
-                logger.error(f"[{self.name}] Error in recording: {e}", exc_info=True)
-                if not self._stop_event.is_set():
-                    logger.info(
-                        f"[{self.name}] Retrying in {self.reconnect_delay} seconds..."
+                    await self._terminate_process("periodic restart")
+                    restarted = True
+                    break
+
+                # Periodic health check
+                if current_time - last_health_check >= self.HEALTH_CHECK_INTERVAL:
+                    # The scan stats the recording mount; off the loop, a slow
+                    # NAS can't stall the other cameras
+                    healthy = await asyncio.to_thread(
+                        self._check_ffmpeg_health, self.HEALTH_CHECK_INTERVAL * 2
                     )
-                    self._stop_event.wait(self.reconnect_delay)
+                    if not healthy:
+                        # FFmpeg appears to be hung, force restart
+                        logger.warning(
+                            f"[{self.name}] FFmpeg health check failed, "
+                            f"forcing restart..."
+                        )
+                        await self._terminate_process("health check failure")
+                        restarted = True
+                        break
+                    last_health_check = current_time
+        finally:
+            exit_task.cancel()
+            if drain_task is not None:
+                drain_task.cancel()
+
+        return restarted
+
+    async def _cancel(self) -> None:
+        """Cancel the recording task and wait for its cleanup"""
+        task = self._task
+        if task is None or task.done():
+            return
+        task.cancel()
+        await asyncio.wait({task})
 
     def start(self) -> None:
-        """Start recording in a separate thread"""
-        if self._thread is not None and self._thread.is_alive():
+        """Start recording on the shared recorder event loop"""
+        if self.is_running():
             logger.warning(f"[{self.name}] Recorder already running")
             return
 
-        self._stop_event.clear()
-        self._thread = threading.Thread(target=self._run_ffmpeg, daemon=True)
-        self._thread.start()
+        self._loop = _get_event_loop()
+        self._future = asyncio.run_coroutine_threadsafe(self._run_ffmpeg(), self._loop)
         logger.info(f"[{self.name}] Recorder started")
 
     def stop(self) -> None:
         """Stop recording gracefully"""
         logger.info(f"[{self.name}] Stopping recorder...")
-        self._stop_event.set()
-
-        # Terminate FFmpeg process
-        self._terminate_process("stopping recorder")
 
-        # Wait for thread to finish
-        if self._thread is not None:
-            self._thread.join(timeout=10)
+        # Cancelling the task terminates FFmpeg; wait for it to finish
+        if self._loop is not None and self.is_running():
+            try:
+                asyncio.run_coroutine_threadsafe(self._cancel(), self._loop).result(
+                    timeout=10
+                )
+            except TimeoutError:
+                logger.warning(f"[{self.name}] Recorder did not stop in time")
 
         logger.info(f"[{self.name}] Recorder stopped")
 
     def is_running(self) -> bool:
         """Check if recorder is running"""
-        return self._thread is not None and self._thread.is_alive()
+        return self._future is not None and not self._future.done()
@@ -0,0 +1,122 @@
+"""Directory change notifications using Linux inotify"""
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import selectors
+import struct
+import sys
+import threading
+from pathlib import Path
+
+
+logger = logging.getLogger(__name__)
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+
+_EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+
+
+class DirectoryWatcher:
+    """Reports files that finished being written into a directory
+
+    Uses inotify through libc, so it is only available on Linux. Use
+    DirectoryWatcher.create(), which returns None when inotify can't be used
+    and callers should fall back to polling.
+    """
+
+    def __init__(self, path: str | Path):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f"inotify_init1 failed: {os.strerror(errno)}")
+
+        wd = libc.inotify_add_watch(fd, os.fsencode(path), IN_CLOSE_WRITE | IN_MOVED_TO)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(errno, f"inotify_add_watch failed: {os.strerror(errno)}")
+
+        self.path = Path(path)
+        self._fd = fd
+        # Lets another thread interrupt wait() without a timeout
+        self._wake_r, self._wake_w = os.pipe()
+        # select.select() can't take fds >= 1024, which many cameras reach
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(fd, selectors.EVENT_READ)
+        self._selector.register(self._wake_r, selectors.EVENT_READ)
+        self._lock = threading.Lock()
+        self._closed = False
+
+    @classmethod
+    def create(cls, path: str | Path) -> "DirectoryWatcher | None":
+        """Create a watcher, or return None if inotify is unavailable"""
+        if not sys.platform.startswith("linux"):
+            return None
+
+        try:
+            return cls(path)
+        except (OSError, AttributeError) as e:
+            logger.warning("Cannot watch %s with inotify, polling instead: %s", path, e)
+            return None
+
+    def wait(self, timeout: float | None) -> list[str]:
+        """Wait for events and return the names of written files
+
+        Returns an empty list on timeout or wake(). Events without a file
+        name (e.g. a queue overflow) are reported as an empty string.
+        """
+        readable = {key.fd for key, _ in self._selector.select(timeout)}
+
+        if self._wake_r in readable:
+            os.read(self._wake_r, 512)
+
+        names = []
+        if self._fd in readable:
+            while True:
+                try:
+                    buf = os.read(self._fd, 64 * 1024)
+                except BlockingIOError:
+                    break
+
+                offset = 0
+                while offset + _EVENT_HEADER.size <= len(buf):
+                    _, mask, _, length = _EVENT_HEADER.unpack_from(buf, offset)
+                    offset += _EVENT_HEADER.size
+                    name = buf[offset : offset + length].rstrip(b"\0")
+                    offset += length
+
+                    if mask & IN_Q_OVERFLOW:
+                        logger.warning("inotify queue overflow on %s", self.path)
+                    names.append(os.fsdecode(name))
+
+        return names
+
+    def wake(self) -> None:
+        """Interrupt a pending wait() from another thread"""
+        with self._lock:
+            if self._closed:
+                return
+            try:
+                os.write(self._wake_w, b"\0")
+            except OSError:
+                pass
+
+    def close(self) -> None:
+        """Release the inotify and wake-up file descriptors"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._selector.close()
+            for fd in (self._fd, self._wake_r, self._wake_w):
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
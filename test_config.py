@@ -1,147 +1,243 @@
 #!/usr/bin/env python3
 """Test configuration and verify system requirements"""
 
+import argparse
+import json
+import os
+import select
+import shutil
 import sys
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 
-def check_ffmpeg():
+def _ffmpeg_cache_path():
+    """Where the last successful FFmpeg version check is remembered"""
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return Path(cache_home) / "cams-manager" / "ffmpeg-version"
+
+
+def check_ffmpeg(out):
     """Check if FFmpeg is installed"""
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg is None:
+        out.append("✗ FFmpeg is not installed")
+        out.append("  Install with: sudo apt install ffmpeg")
+        return False
+
+    # Skip running ffmpeg -version again while the binary is unchanged
     try:
-        result = subprocess.run(
-            ["ffmpeg", "-version"],
-            capture_output=True,
-            text=True,
-            timeout=5,
-        )
-        if result.returncode == 0:
-            version = result.stdout.split("\n")[0]
-            print(f"✓ FFmpeg is installed: {version}")
+        st = os.stat(ffmpeg)
+        key = [ffmpeg, st.st_mtime_ns, st.st_size]
+    except OSError:
+        key = None
+    if key is not None:
+        try:
+            cached = json.loads(_ffmpeg_cache_path().read_text(encoding="utf-8"))
+            if cached["key"] == key:
+                out.append(f"✓ FFmpeg is installed: {cached['version']}")
+                return True
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    try:
+        # Only the first line is shown, so stop reading once it arrives
+        with subprocess.Popen(
+            [ffmpeg, "-version"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        ) as proc:
+            ready, _, _ = select.select([proc.stdout], [], [], 5)
+            first_line = proc.stdout.readline() if ready else b""
+            proc.terminate()
+            proc.wait(timeout=1)
+        if first_line.strip():
+            version = first_line.rstrip(b"\r\n").decode(errors="replace")
+            out.append(f"✓ FFmpeg is installed: {version}")
+            if key is not None:
+                try:
+                    cache_path = _ffmpeg_cache_path()
+                    cache_path.parent.mkdir(parents=True, exist_ok=True)
+                    cache_path.write_text(
+                        json.dumps({"key": key, "version": version}),
+                        encoding="utf-8",
+                    )
+                except OSError:
+                    pass
             return True
         else:
-            print("✗ FFmpeg is installed but returned an error")
+            out.append("✗ FFmpeg is installed but returned an error")
             return False
     except FileNotFoundError:
-        print("✗ FFmpeg is not installed")
-        print("  Install with: sudo apt install ffmpeg")
+        out.append("✗ FFmpeg is not installed")
+        out.append("  Install with: sudo apt install ffmpeg")
         return False
     except Exception as e:
-        print(f"✗ Error checking FFmpeg: {e}")
+        out.append(f"✗ Error checking FFmpeg: {e}")
         return False
 
 
-def check_config():
+def check_config(out):
     """Check if config file exists"""
     config_path = Path("config.yaml")
     if config_path.exists():
-        print(f"✓ Config file exists: {config_path}")
+        out.append(f"✓ Config file exists: {config_path}")
         return True
     else:
-        print("✗ Config file not found: config.yaml")
-        print("  Copy config.yaml.example to config.yaml and edit it")
+        out.append("✗ Config file not found: config.yaml")
+        out.append("  Copy config.yaml.example to config.yaml and edit it")
         return False
 
 
-def check_python_version():
+def check_python_version(out):
     """Check Python version"""
     version = sys.version_info
     if version.major == 3 and version.minor >= 13:
-        print(f"✓ Python version: {version.major}.{version.minor}.{version.micro}")
+        out.append(f"✓ Python version: {version.major}.{version.minor}.{version.micro}")
         return True
     else:
-        print(
+        out.append(
             f"✗ Python version {version.major}.{version.minor}.{version.micro} is too old"
         )
-        print("  Requires Python 3.13 or newer")
+        out.append("  Requires Python 3.13 or newer")
         return False
 
 
-def load_and_validate_config():
+def load_and_validate_config(out):
     """Load config and validate"""
     try:
-        import yaml
-
         config_path = Path("config.yaml")
         if not config_path.exists():
             return False
 
-        with open(config_path, "r", encoding="utf-8") as f:
-            config = yaml.safe_load(f)
+        # Only import PyYAML once there is a config to parse
+        import yaml
 
-        # Check cameras
+        loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+        with open(config_path, "rb") as f:
+            config = yaml.load(f, Loader=loader)
 
-        if not config.cameras:
-            print("✗ No cameras defined in config")
+        # Check cameras
+        cameras = (config or {}).get("cameras") or []
+        if not cameras:
+            out.append("✗ No cameras defined in config")
             return False
 
-        print(f"✓ Found {len(config.cameras)} camera(s) in config")
+        out.append(f"✓ Found {len(cameras)} camera(s) in config")
 
         # Check each camera
-        for cam in config.cameras:
+        for cam in cameras:
             name = cam.get("name", "unnamed")
-            rtsp_url = cam.get("rtsp_url", "")
-            output_dir = cam.get("output_dir", "")
-
-            if not rtsp_url:
-                print(f"  ✗ Camera {name}: missing rtsp_url")
+            if not cam.get("rtsp_url", ""):
+                out.append(f"  ✗ Camera {name}: missing rtsp_url")
                 return False
 
-            if not output_dir:
-                print(f"  ✗ Camera {name}: missing output_dir")
+            if not cam.get("output_dir", ""):
+                out.append(f"  ✗ Camera {name}: missing output_dir")
                 return False
 
-            # Check if output directory exists or can be created
-            output_path = Path(output_dir)
-            if not output_path.exists():
-                print(
-                    f"  ! Camera {name}: output directory does not exist: {output_dir}"
+        # List each parent directory once instead of a stat per camera
+        existing = {}
+        for cam in cameras:
+            parent = Path(cam["output_dir"]).parent
+            if parent not in existing:
+                try:
+                    with os.scandir(parent) as entries:
+                        existing[parent] = {e.name for e in entries if e.is_dir()}
+                except OSError:
+                    existing[parent] = set()
+
+        # Check if output directory exists or can be created
+        for cam in cameras:
+            name = cam.get("name", "unnamed")
+            output_path = Path(cam["output_dir"])
+            if output_path.name:
+                exists = output_path.name in existing[output_path.parent]
+            else:
+                # e.g. "/" or ".", which have no entry in a parent listing
+                exists = output_path.is_dir()
+            if not exists:
+                out.append(
+                    f"  ! Camera {name}: output directory does not exist: {output_path}"
                 )
-                print("    Will be created automatically")
+                out.append("    Will be created automatically")
             else:
-                print(f"  ✓ Camera {name}: output directory exists")
+                out.append(f"  ✓ Camera {name}: output directory exists")
 
         return True
 
     except ImportError:
-        print("✗ PyYAML not installed")
-        print("  Run: uv sync")
+        out.append("✗ PyYAML not installed")
+        out.append("  Run: uv sync")
         return False
     except Exception as e:
-        print(f"✗ Error loading config: {e}")
+        out.append(f"✗ Error loading config: {e}")
         return False
 
 
-def main():
-    """Main test function"""
-    print("=== cams-manager Configuration Test ===\n")
+def run_check(name, check_func):
+    """Run one check, returning whether it passed and the lines it reported"""
+    out = []
+    try:
+        result = bool(check_func(out))
+    except Exception as e:
+        out.append(f"✗ {name} check failed: {e}")
+        result = False
+    return result, out
+
 
-    checks = [
-        ("Python Version", check_python_version),
-        ("FFmpeg", check_ffmpeg),
-        ("Config File", check_config),
-        ("Config Validation", load_and_validate_config),
-    ]
+CHECKS = [
+    ("Python Version", check_python_version),
+    ("FFmpeg", check_ffmpeg),
+    ("Config File", check_config),
+    ("Config Validation", load_and_validate_config),
+]
+
+
+def main(argv=None):
+    """Main test function"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "-q", "--quiet", action="store_true", help="Only print the summary"
+    )
+    parser.add_argument(
+        "--fail-fast", action="store_true", help="Stop at the first failed check"
+    )
+    args = parser.parse_args(argv)
 
     results = []
-    for name, check_func in checks:
-        try:
-            result = check_func()
-            results.append(result)
-        except Exception as e:
-            print(f"✗ {name} check failed: {e}")
-            results.append(False)
-        print()
+    if args.fail_fast:
+        for name, check_func in CHECKS:
+            results.append(run_check(name, check_func))
+            if not results[-1][0]:
+                break
+    else:
+        # The checks are independent, so the slow FFmpeg one overlaps the
+        # rest; map() still yields results in table order
+        with ThreadPoolExecutor(max_workers=len(CHECKS)) as executor:
+            results = list(executor.map(lambda check: run_check(*check), CHECKS))
+
+    # Everything is written at once at the end
+    lines = []
+    if not args.quiet:
+        lines.append("=== cams-manager Configuration Test ===\n")
+        for _, out in results:
+            lines.extend(out)
+            lines.append("")
 
     # Summary
-    print("=" * 40)
-    if all(results):
-        print("✓ All checks passed! Ready to run cams-manager")
-        print("\nRun with: uv run cams-manager")
-        return 0
+    lines.append("=" * 40)
+    if len(results) == len(CHECKS) and all(ok for ok, _ in results):
+        lines.append("✓ All checks passed! Ready to run cams-manager")
+        lines.append("\nRun with: uv run cams-manager")
+        status = 0
     else:
-        print("✗ Some checks failed. Please fix the issues above.")
-        return 1
+        lines.append("✗ Some checks failed. Please fix the issues above.")
+        status = 1
+
+    sys.stdout.write("\n".join(lines) + "\n")
+    return status
 
 
 if __name__ == "__main__":